@@ -1,16 +1,28 @@
+# Patterns used to repair key files written without quotes, defined once
+# at package load rather than on every repair attempt
+.json_key_pattern <- "([{,]\\s*)(\\w+)\\s*:"
+.json_value_pattern <- ":\\s*([A-Za-z0-9._:@/-]+)(?=\\s*[},])"
+
 #' Gen3 Metadata Parser
 #'
 #' A class to interact with Gen3 metadata API for fetching and processing data.
 #' Perfect for cancer genomics research workflows.
+#' Set `options(gen3MetadataR.verbose = TRUE)` to print progress messages.
 #'
 #' @field key_file_path Path to the JSON authentication key file
+#' @field api_url Base URL of the Gen3 data commons, set by authenticate
 #' @field headers HTTP headers for API authentication  
-#' @field data_store Storage for raw JSON data
+#' @field cache_dir Directory fetched nodes with flat records are written to as Parquet,
+#'   or NULL to keep them in memory
+#' @field data_store Storage for compressed JSON response bodies (or Parquet file paths), read with get_data.
+#'   Entries are removed once data_to_pd has converted them into data_store_pd.
 #' @field data_store_pd Storage for processed data frames
 #'
 #' @importFrom R6 R6Class
 #' @importFrom jsonlite fromJSON
 #' @importFrom httr2 request req_method req_body_json req_perform resp_body_json resp_status req_headers
+#' @importFrom httr2 req_url req_retry req_perform_parallel resp_body_raw req_options
+#' @importFrom httr2 req_url_query
 #' @importFrom stringr str_detect str_replace_all str_remove
 #' @importFrom base64enc base64decode
 #' @importFrom magrittr %>%
@@ -28,7 +40,9 @@ Gen3MetadataParser <- R6Class("Gen3MetadataParser",
   public = list(
     # Instance variables (like Python's __init__)
     key_file_path = NULL,
+    api_url = NULL,
     headers = NULL,
+    cache_dir = NULL,
     data_store = NULL,
     data_store_pd = NULL,
     
@@ -37,8 +51,17 @@ Gen3MetadataParser <- R6Class("Gen3MetadataParser",
     #' Sets up storage and headers, and stores the path to the key file.
     #' 
     #' @param key_file_path Path to the JSON authentication key file.
-    initialize = function(key_file_path) {
+    #' @param cache_dir Optional directory to write fetched nodes to as Parquet
+    #'   files instead of holding them in memory. Requires the arrow package.
+    initialize = function(key_file_path, cache_dir = NULL) {
+      if (!is.null(cache_dir)) {
+        if (!requireNamespace("arrow", quietly = TRUE)) {
+          stop("The arrow package is required to use cache_dir")
+        }
+        dir.create(cache_dir, recursive = TRUE, showWarnings = FALSE)
+      }
       self$key_file_path <- key_file_path
+      self$cache_dir <- cache_dir
       self$headers <- list()
       self$data_store <- list()
       self$data_store_pd <- list()
@@ -56,9 +79,9 @@ Gen3MetadataParser <- R6Class("Gen3MetadataParser",
       }, error = function(e) {
         tryCatch({
           # Add quotes around keys
-          fixed <- str_replace_all(input_str, "([{,]\\s*)(\\w+)\\s*:", "\\1\"\\2\":")
+          fixed <- str_replace_all(input_str, .json_key_pattern, "\\1\"\\2\":")
           # Add quotes around simple string values
-          fixed <- str_replace_all(fixed, ":\\s*([A-Za-z0-9._:@/-]+)(?=\\s*[},])", ": \"\\1\"")
+          fixed <- str_replace_all(fixed, .json_value_pattern, ": \"\\1\"")
           return(fromJSON(fixed))
         }, error = function(e2) {
           stop(paste("Could not fix JSON:", e2$message))
@@ -73,19 +96,24 @@ Gen3MetadataParser <- R6Class("Gen3MetadataParser",
     #'
     #' @return A list representing the credentials.
     load_api_key = function() {
-      tryCatch({
-        # Read file as text first
-        content <- readLines(self$key_file_path, warn = FALSE)
-        content <- paste(content, collapse = "")
+      # Reuse the credentials parsed on a previous call, unless the
+      # key file has been changed since
+      if (!is.null(private$key_cache) && identical(private$key_path, self$key_file_path)) {
+        return(private$key_cache)
+      }
+      
+      private$key_cache <- tryCatch({
+        # Read the whole file once, in a single call
+        content <- readChar(self$key_file_path, file.size(self$key_file_path), useBytes = TRUE)
         
-        # Check if content needs quote fixing
+        # Only files without any quotes need the regex repair
         if (!str_detect(content, '"') && !str_detect(content, "'")) {
-          return(self$add_quotes_to_json(content))
+          self$add_quotes_to_json(content)
+        } else {
+          # Parse the content already in memory
+          fromJSON(content)
         }
         
-        # Try normal JSON parsing
-        return(fromJSON(self$key_file_path))
-        
       }, error = function(e) {
         if (str_detect(e$message, "cannot open the connection")) {
           stop(paste("File not found:", self$key_file_path))
@@ -98,6 +126,8 @@ Gen3MetadataParser <- R6Class("Gen3MetadataParser",
           stop(e)
         }
       })
+      private$key_path <- self$key_file_path
+      return(private$key_cache)
     },
     
     #' @description
@@ -108,31 +138,7 @@ Gen3MetadataParser <- R6Class("Gen3MetadataParser",
     #' @param cred A list of credentials containing the JWT token.
     #' @return The base API URL as a string.
     url_from_jwt = function(cred) {
-      jwt_token <- cred$api_key
-      
-      # JWT tokens have 3 parts separated by dots: header.payload.signature
-      # We only need the payload (middle part)
-      parts <- strsplit(jwt_token, "\\.")[[1]]
-      
-      if (length(parts) != 3) {
-          stop("Invalid JWT token format")
-      }
-      
-      # Decode the payload (base64url decoding)
-      payload_encoded <- parts[2]
-      
-      # Add padding if needed (base64url doesn't always have padding)
-      missing_padding <- 4 - (nchar(payload_encoded) %% 4)
-      if (missing_padding != 4) {
-          payload_encoded <- paste0(payload_encoded, paste(rep("=", missing_padding), collapse = ""))
-      }
-      
-      # Convert base64url to base64 (replace - with + and _ with /)
-      payload_base64 <- chartr("-_", "+/", payload_encoded)
-      
-      # Decode and parse JSON
-      payload_json <- rawToChar(base64enc::base64decode(payload_base64))
-      decoded <- fromJSON(payload_json)
+      decoded <- private$decode_jwt(cred$api_key)
       
       # Extract issuer and remove "/user" suffix
       url <- str_remove(decoded$iss %||% "", "/user$")
@@ -142,20 +148,30 @@ Gen3MetadataParser <- R6Class("Gen3MetadataParser",
     #' @description
     #' Authenticate with the Gen3 API using the loaded credentials.
     #' Obtains an access token and stores it in the headers for future requests.
+    #'
+    #' @return The authentication headers, invisibly.
     authenticate = function() {
       tryCatch({
         key <- self$load_api_key()
         api_url <- self$url_from_jwt(key)
+        # Build on a fresh base request so no header from a previous key is
+        # kept; nothing on self changes until a token has come back
+        session <- private$new_session(api_url)
         
-        response <- request(paste0(api_url, "/user/credentials/cdis/access_token")) %>%
+        response <- session %>%
+          req_url(paste0(api_url, "/user/credentials/cdis/access_token")) %>%
           req_method("POST") %>%
           req_body_json(key) %>%
           req_perform()
         
         access_token <- resp_body_json(response)$access_token
-        self$headers <- list(Authorization = paste("bearer", access_token))
+        headers <- list(Authorization = paste("bearer", access_token))
+        self$api_url <- api_url
+        self$headers <- headers
+        private$session <- session %>% req_headers(!!!headers)
+        private$auth_path <- self$key_file_path
         
-        cat("Authentication successful:", resp_status(response), "\n")
+        private$log_debug("Authentication successful:", resp_status(response))
         
       }, error = function(e) {
         if (inherits(e, "httr2_http_error")) {
@@ -166,6 +182,7 @@ Gen3MetadataParser <- R6Class("Gen3MetadataParser",
         }
         stop(e)
       })
+      invisible(self$headers)
     },
     
     #' @description
@@ -176,6 +193,20 @@ Gen3MetadataParser <- R6Class("Gen3MetadataParser",
     #' @param json_data The JSON data to be converted to a data.frame.
     #' @return A flattened data.frame.
     json_to_pd = function(json_data) {
+      if (private$is_flat_records(json_data)) {
+        # Flat records: build one vector per column; there is nothing to flatten.
+        # Columns are the union of keys across all records, in first-seen order.
+        # Arrow's JSON reader is deliberately not used here: the records are
+        # already parsed, so it would mean re-serialising them to NDJSON and
+        # parsing twice, and its type inference would differ from this path
+        cols <- unique(unlist(lapply(json_data, names)))
+        columns <- lapply(cols, function(col) {
+          unlist(lapply(json_data, function(record) record[[col]] %||% NA))
+        })
+        names(columns) <- cols
+        return(list2DF(columns, nrow = length(json_data)))
+      }
+      
       # This is like flattening nested JSON into a nice tabular format
       # Use jsonlite::flatten to flatten nested data.frames
       df <- as.data.frame(json_data)
@@ -188,37 +219,33 @@ Gen3MetadataParser <- R6Class("Gen3MetadataParser",
     #' @description
     #' Fetch metadata from the Gen3 API for a given program, project, and node label.
     #' Stores the result in the data_store slot, and optionally returns the data.
+    #' Authenticates first if authenticate has not been called yet.
     #' 
     #' @param program_name Name of the Gen3 program
     #' @param project_code Code of the Gen3 project
     #' @param node_label Node label to fetch (e.g., "sample")
-    #' @param return_data If TRUE, returns the data instead of just storing it
+    #' @param return_data If TRUE, also returns the parsed JSON data as a list
     #' @param api_version API version string (default "v0")
     fetch_data = function(program_name, project_code, node_label, 
                          return_data = FALSE, api_version = "v0") {
       tryCatch({
-        creds <- self$load_api_key()
-        api_url <- self$url_from_jwt(creds)
-        
-        url <- paste0(api_url, "/api/", api_version, "/submission/", 
-                     program_name, "/", project_code, 
-                     "/export/?node_label=", node_label, "&format=json")
-        
-        response <- request(url) %>%
-          req_headers(!!!self$headers) %>%
+        private$ensure_authenticated()
+        response <- private$export_request(program_name, project_code, node_label, api_version) %>%
           req_perform()
         
-        cat("status code:", resp_status(response), "\n")
-        
-        data <- resp_body_json(response)
+        private$log_debug("status code:", resp_status(response))
         
         key <- paste(program_name, project_code, node_label, sep = "/")
-        self$data_store[[key]] <- data
+        body <- resp_body_raw(response)
+        # Parse the body once here when it is returned, so the shape does not
+        # depend on cache_dir and store_response can reuse it
+        payload <- if (return_data) private$parse_json(body) else NULL
+        private$store_response(key, body, payload)
         
         if (return_data) {
-          return(data)
+          return(payload)
         } else {
-          cat("Data for", key, "has been fetched and stored.\n")
+          private$log_debug("Data for", key, "has been fetched and stored.")
         }
         
       }, error = function(e) {
@@ -232,15 +259,265 @@ Gen3MetadataParser <- R6Class("Gen3MetadataParser",
       })
     },
     
+    #' @description
+    #' Fetch metadata for several nodes concurrently.
+    #' Requests are performed in parallel and each result is stored in the
+    #' data_store slot under the same key fetch_data would use.
+    #'
+    #' @param specs A list of character vectors, each c(program_name, project_code, node_label)
+    #' @param max_active Maximum number of requests in flight at once (default 8)
+    #' @param api_version API version string (default "v0")
+    fetch_many = function(specs, max_active = 8, api_version = "v0") {
+      tryCatch({
+        private$ensure_authenticated()
+        # Wait for an existing HTTP/2 connection rather than opening a new
+        # one, so the requests are multiplexed over a single connection
+        reqs <- lapply(specs, function(spec) {
+          private$export_request(spec[[1]], spec[[2]], spec[[3]], api_version) %>%
+            req_options(pipewait = 1L)
+        })
+        responses <- req_perform_parallel(reqs, max_active = max_active,
+                                          progress = isTRUE(getOption("gen3MetadataR.verbose")))
+        
+        for (i in seq_along(specs)) {
+          key <- paste(unlist(specs[[i]]), collapse = "/")
+          private$store_response(key, resp_body_raw(responses[[i]]))
+          private$log_debug("Data for", key, "has been fetched and stored.")
+        }
+        invisible(self)
+        
+      }, error = function(e) {
+        if (inherits(e, "httr2_http_error")) {
+          cat("HTTP error occurred:", e$message, "\n")
+          cat("Status Code:", resp_status(e$response), "\n")
+        } else {
+          cat("An error occurred:", e$message, "\n")
+        }
+        stop(e)
+      })
+    },
+    
+    #' @description
+    #' Return the parsed metadata stored in data_store under a given key.
+    #' The stored body is decompressed and parsed on every call.
+    #' For entries written to Parquet (see cache_dir), the records are read
+    #' back and returned as a data.frame in the data element.
+    #'
+    #' @param key A data_store key, in the form "program/project/node".
+    #' @return A list representing the fetched JSON data. Its data element holds
+    #'   the node's records: a list, or a data.frame for entries stored as Parquet.
+    get_data = function(key) {
+      entry <- self$data_store[[key]]
+      if (is.character(entry)) {
+        return(list(data = as.data.frame(arrow::read_parquet(entry))))
+      }
+      return(private$parse_json(memDecompress(entry, type = "gzip")))
+    },
+    
     #' @description
     #' Convert all stored JSON metadata in data_store to data.frames and store in data_store_pd.
     #' Each key in data_store_pd corresponds to a key in data_store.
+    #' Converted entries are removed from data_store to free their memory.
+    #' If any node fails to convert, an error is raised and nothing is changed.
     data_to_pd = function() {
-      for (key in names(self$data_store)) {
-        cat("Converting", key, "to data.frame...\n")
-        self$data_store_pd[[key]] <- self$json_to_pd(self$data_store[[key]]$data)
+      keys <- names(self$data_store)
+      for (key in keys) {
+        private$log_debug("Converting", key, "to data.frame...")
       }
+      convert <- function(key) {
+        entry <- self$data_store[[key]]
+        if (is.character(entry)) {
+          return(self$get_data(key)$data)
+        }
+        body <- memDecompress(entry, type = "gzip")
+        self$json_to_pd(private$parse_json(body, fast = TRUE)$data)
+      }
+      
+      # Forking workers only pays off once there are a few nodes to convert.
+      # Arrow runs its own thread pools, and forking a threaded process can
+      # hang the children, so stay serial once arrow is in use.
+      use_fork <- length(keys) >= 4 && .Platform$OS.type == "unix" &&
+        is.null(self$cache_dir) && !isNamespaceLoaded("arrow")
+      if (use_fork) {
+        cores <- min(length(keys), parallel::detectCores(), na.rm = TRUE)
+        results <- parallel::mclapply(keys, convert, mc.cores = cores)
+      } else {
+        results <- lapply(keys, convert)
+      }
+      
+      # mclapply() returns try-error objects (or NULL for a killed worker)
+      # instead of raising, so stop before any stored body is dropped
+      failed <- vapply(results, function(result) {
+        is.null(result) || inherits(result, "try-error")
+      }, logical(1))
+      if (any(failed)) {
+        first <- results[[which(failed)[1]]]
+        reason <- if (is.null(first)) "worker did not return" else conditionMessage(attr(first, "condition"))
+        stop(paste0("Could not convert ", paste(keys[failed], collapse = ", "), ": ", reason))
+      }
+      self$data_store_pd[keys] <- results
+      self$data_store[keys] <- NULL
       invisible(self)  # R equivalent of Python's None return
     }
+  ),
+  
+  private = list(
+    # Credentials cached after the first load, and the file they came from
+    key_cache = NULL,
+    key_path = NULL,
+    # Key file used by the last successful authenticate() call
+    auth_path = NULL,
+    # Claims decoded from the JWT, and the token they were decoded from
+    claims = NULL,
+    claims_token = NULL,
+    # Base request shared by every call to the Gen3 host
+    session = NULL,
+    # Path of the export endpoint: api version, program, project
+    export_path = "/api/%s/submission/%s/%s/export/",
+    
+    # Authenticate on first use, or again if the key file has changed
+    # since the last successful authentication.
+    ensure_authenticated = function() {
+      if (is.null(self$api_url) || !identical(private$auth_path, self$key_file_path)) {
+        self$authenticate()
+      }
+    },
+    
+    # Return the shared base request, building it on first use.
+    get_session = function() {
+      if (is.null(private$session)) {
+        private$session <- private$new_session(self$api_url)
+      }
+      return(private$session)
+    },
+    
+    # Build a base request for a Gen3 host, without any auth headers.
+    # HTTP/2 is negotiated over TLS, and transient failures are retried
+    # with exponential backoff, or after the server's Retry-After delay
+    # when one is sent.
+    new_session = function(api_url) {
+      request(api_url) %>%
+        req_options(http_version = 4L) %>%  # CURL_HTTP_VERSION_2TLS
+        req_retry(
+          max_tries = 6,
+          is_transient = function(resp) resp_status(resp) %in% c(429, 500, 502, 503, 504),
+          backoff = function(i) 0.5 * 2^(i - 1)
+        )
+    },
+    
+    # Build the export request for a single program/project/node.
+    # Query parameters are URL-encoded by httr2 rather than pasted in.
+    export_request = function(program_name, project_code, node_label, api_version) {
+      path <- sprintf(private$export_path, api_version, program_name, project_code)
+      return(private$get_session() %>%
+        req_url(paste0(self$api_url, path)) %>%
+        req_url_query(node_label = node_label, format = "json"))
+    },
+    
+    # Decode the JWT payload into a list of claims.
+    # The claims are kept so the same token is only ever decoded once.
+    decode_jwt = function(jwt_token) {
+      if (!identical(private$claims_token, jwt_token)) {
+        # JWT tokens have 3 parts separated by dots: header.payload.signature
+        # We only need the payload (middle part)
+        parts <- strsplit(jwt_token, ".", fixed = TRUE)[[1]]
+        
+        if (length(parts) != 3) {
+            stop("Invalid JWT token format")
+        }
+        
+        # Decode the payload (base64url decoding)
+        payload_encoded <- parts[2]
+        
+        # Add padding if needed (base64url doesn't always have padding)
+        missing_padding <- 4 - (nchar(payload_encoded) %% 4)
+        if (missing_padding != 4) {
+            payload_encoded <- paste0(payload_encoded, paste(rep("=", missing_padding), collapse = ""))
+        }
+        
+        # Convert base64url to base64 (replace - with + and _ with /)
+        payload_base64 <- chartr("-_", "+/", payload_encoded)
+        
+        # Decode and parse JSON (claims are read by name, so skip simplification)
+        payload_json <- rawToChar(base64enc::base64decode(payload_base64))
+        private$claims <- jsonlite::parse_json(payload_json)
+        private$claims_token <- jwt_token
+      }
+      return(private$claims)
+    },
+    
+    # Check whether json_data is a list of records with no nested values.
+    is_flat_records = function(json_data) {
+      if (!is.list(json_data) || length(json_data) == 0 || !is.null(names(json_data))) {
+        return(FALSE)
+      }
+      all(vapply(json_data, function(record) {
+        is.list(record) && !any(vapply(record, is.list, logical(1)))
+      }, logical(1)))
+    },
+    
+    # Keep a fetched response body in data_store. When cache_dir is set,
+    # flat records are written to Parquet and only the path is kept;
+    # otherwise, or if the write fails, the compressed body is kept.
+    # payload is the already-parsed body, if the caller has one.
+    store_response = function(key, body, payload = NULL) {
+      if (!is.null(self$cache_dir)) {
+        path <- private$write_parquet(key, body, payload)
+        if (!is.null(path)) {
+          self$data_store[[key]] <- path
+          return(invisible(NULL))
+        }
+      }
+      self$data_store[[key]] <- memCompress(body, type = "gzip")
+      invisible(NULL)
+    },
+    
+    # Write a node's records to cache_dir as Parquet and return the path.
+    # Returns NULL for nodes that should stay in memory: nested records are
+    # expected and only logged, but parse and write failures are warned about.
+    write_parquet = function(key, body, payload) {
+      tryCatch({
+        if (is.null(payload)) {
+          payload <- private$parse_json(body, fast = TRUE)
+        }
+        records <- payload$data
+        if (!private$is_flat_records(records)) {
+          private$log_debug("Keeping", key, "in memory: its records are not flat")
+          return(NULL)
+        }
+        # Encoding the key keeps file names unique: "/" becomes "%2F"
+        # and "%" itself is escaped, so no two keys share a file
+        file_name <- paste0(utils::URLencode(key, reserved = TRUE), ".parquet")
+        parquet_path <- file.path(self$cache_dir, file_name)
+        arrow::write_parquet(self$json_to_pd(records), parquet_path, compression = "zstd")
+        parquet_path
+      }, error = function(e) {
+        warning(paste("Could not write", key, "to Parquet, keeping it in memory:", conditionMessage(e)),
+                call. = FALSE)
+        NULL
+      })
+    },
+    
+    # Emit a progress message when the gen3MetadataR.verbose option is set.
+    log_debug = function(...) {
+      if (isTRUE(getOption("gen3MetadataR.verbose"))) {
+        message(paste(...))
+      }
+    },
+    
+    # Parse a raw JSON response body into nested lists.
+    # By default this is jsonlite::parse_json, so JSON null inside records
+    # comes back as NULL, the same as resp_body_json(). With fast = TRUE the
+    # SIMD-accelerated simdjson parser is used when it is installed; it
+    # returns NA for those nulls, so it is only used where the records go
+    # straight into json_to_pd, which treats NULL and NA alike.
+    parse_json = function(body, fast = FALSE) {
+      if (fast && requireNamespace("RcppSIMDJson", quietly = TRUE)) {
+        return(RcppSIMDJson::fparse(body, max_simplify_lvl = "list",
+                                    empty_array = list(),
+                                    empty_object = structure(list(), names = character(0))))
+      }
+      return(jsonlite::parse_json(rawToChar(body)))
+    }
   )
 )
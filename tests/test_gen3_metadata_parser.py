@@ -1,13 +1,13 @@
 import pytest
 import json
-from unittest.mock import patch, mock_open, MagicMock
+from unittest.mock import patch, MagicMock
 from requests.exceptions import HTTPError, RequestException
 from gen3_metadata.gen3_metadata_parser import Gen3MetadataParser 
 import requests
 import pandas as pd
 import jwt
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def fake_api_key():
     """Fixture to provide a fake API key. Note: these credentials have been inactivated."""
     # This is a valid JWT and UUID, but is not active.
@@ -35,6 +35,18 @@ def gen3_metadata_parser():
     """Fixture to create a Gen3MetadataParser instance."""
     return Gen3MetadataParser(key_file_path="fake_credentials.json")
 
+@pytest.fixture(scope="session")
+def key_path(tmp_path_factory, fake_api_key):
+    """Fixture to write the fake API key to a real credentials file once per session."""
+    path = tmp_path_factory.mktemp("key") / "cred.json"
+    path.write_text(json.dumps(fake_api_key))
+    return str(path)
+
+@pytest.fixture
+def key_file_parser(key_path):
+    """Fixture to create a Gen3MetadataParser instance backed by the credentials file."""
+    return Gen3MetadataParser(key_file_path=key_path)
+
 @pytest.fixture
 def malformed_json_credentials():
     """Fixture for malformed JSON credentials (no quotes, not valid Python dict)."""
@@ -70,27 +82,26 @@ def test_add_quotes_to_json_invalid(gen3_metadata_parser):
     with pytest.raises(ValueError):
         gen3_metadata_parser._add_quotes_to_json(bad)
 
-def test_load_api_key_valid_json(gen3_metadata_parser, fake_api_key):
+def test_load_api_key_valid_json(key_file_parser, fake_api_key):
     """Test the _load_api_key method with valid JSON file content."""
-    # Simulate reading a valid JSON file
-    with patch("builtins.open", mock_open(read_data=json.dumps(fake_api_key))):
-        result = gen3_metadata_parser._load_api_key()
-        assert result == fake_api_key
+    result = key_file_parser._load_api_key()
+    assert result == fake_api_key
 
-def test_load_api_key_malformed_json(gen3_metadata_parser, malformed_json_credentials):
+def test_load_api_key_malformed_json(tmp_path, malformed_json_credentials):
     """Test the _load_api_key method with malformed JSON (no quotes)."""
-    # Simulate reading a malformed JSON file (no quotes)
-    with patch("builtins.open", mock_open(read_data=malformed_json_credentials)):
-        result = gen3_metadata_parser._load_api_key()
-        assert result == {"api_key": "abc.def.ghi", "key_id": "18bdaa-b018"}
+    # Write a malformed JSON file (no quotes)
+    path = tmp_path / "cred.json"
+    path.write_text(malformed_json_credentials)
+    result = Gen3MetadataParser(key_file_path=str(path))._load_api_key()
+    assert result == {"api_key": "abc.def.ghi", "key_id": "18bdaa-b018"}
 
-def test_load_api_key_invalid_json(gen3_metadata_parser):
+def test_load_api_key_invalid_json(tmp_path):
     """Test the _load_api_key method with unrecoverable malformed JSON."""
-    # Simulate reading a badly malformed JSON file
-    bad_content = '{key1 value1, key2:}'
-    with patch("builtins.open", mock_open(read_data=bad_content)):
-        with pytest.raises(ValueError):
-            gen3_metadata_parser._load_api_key()
+    # Write a badly malformed JSON file
+    path = tmp_path / "cred.json"
+    path.write_text('{key1 value1, key2:}')
+    with pytest.raises(ValueError):
+        Gen3MetadataParser(key_file_path=str(path))._load_api_key()
 
 def test_url_from_jwt(gen3_metadata_parser, fake_api_key):
     """Test if you can infer the data commons url from the JWT token"""
@@ -158,7 +169,7 @@ def test_json_to_pd(gen3_metadata_parser):
 
 
 @patch("requests.get")
-def test_fetch_data_success(mock_get, gen3_metadata_parser, fake_api_key):
+def test_fetch_data_success(mock_get, key_file_parser):
     """Test fetch_data for successful API response."""
     fake_response = {"data": [{"id": 1, "name": "test"}]}
     mock_get.return_value.status_code = 200
@@ -168,15 +179,14 @@ def test_fetch_data_success(mock_get, gen3_metadata_parser, fake_api_key):
     project_code = "test_project"
     node_label = "subjects"
     
-    with patch("builtins.open", mock_open(read_data=json.dumps(fake_api_key))):
-        gen3_metadata_parser.fetch_data(program_name, project_code, node_label, return_data=False)
-        key = f"{program_name}/{project_code}/{node_label}"
-        assert key in gen3_metadata_parser.data_store
-        assert gen3_metadata_parser.data_store[key] == fake_response
+    key_file_parser.fetch_data(program_name, project_code, node_label, return_data=False)
+    key = f"{program_name}/{project_code}/{node_label}"
+    assert key in key_file_parser.data_store
+    assert key_file_parser.data_store[key] == fake_response
 
 
 @patch("requests.get")
-def test_fetch_data_http_error(mock_get, gen3_metadata_parser, fake_api_key):
+def test_fetch_data_http_error(mock_get, key_file_parser):
     """Test fetch_data when API returns an HTTP error."""
     mock_get.return_value.status_code = 404
     mock_get.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError("Not Found")
@@ -186,8 +196,7 @@ def test_fetch_data_http_error(mock_get, gen3_metadata_parser, fake_api_key):
     node_label = "subjects"
 
     with pytest.raises(requests.exceptions.HTTPError):
-        with patch("builtins.open", mock_open(read_data=json.dumps(fake_api_key))):
-            gen3_metadata_parser.fetch_data(program_name, project_code, node_label)
+        key_file_parser.fetch_data(program_name, project_code, node_label)
 
 
 @pytest.fixture